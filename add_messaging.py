@@ -2,40 +2,20 @@
 ================================================================================
 MESSAGING SYSTEM - Database Setup
 ================================================================================
-Add this to existing database initialization
-Run this script ONCE to add the messages table
+The messages table is part of the versioned schema in app.migrate_database;
+this script simply runs that migration
 ================================================================================
 """
 
 import sqlite3
-from datetime import datetime
+from app import migrate_database
 
 def add_messaging_system():
     """Add messages table to existing database"""
-    conn = sqlite3.connect('cellar_society.db')
-    c = conn.cursor()
-    
     try:
-        # Create messages table
-        c.execute('''CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            customer_id INTEGER NOT NULL,
-            sender_type TEXT NOT NULL,
-            message TEXT NOT NULL,
-            is_read INTEGER DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (customer_id) REFERENCES customers(id)
-        )''')
+        migrate_database()
+        print("✅ Messages table and index are in place")
         
-        print("✅ Messages table created successfully!")
-        
-        # Add index for faster queries
-        c.execute('''CREATE INDEX IF NOT EXISTS idx_messages_customer 
-                     ON messages(customer_id, created_at DESC)''')
-        
-        print("✅ Added index for messages")
-        
-        conn.commit()
         print("\n✅ Messaging system setup complete!")
         print("\nTable structure:")
         print("- id: Message ID")
@@ -45,11 +25,8 @@ def add_messaging_system():
         print("- is_read: 0 (unread) or 1 (read)")
         print("- created_at: Timestamp")
         
-    except Exception as e:
+    except sqlite3.Error as e:
         print(f"❌ Error: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
 
 if __name__ == '__main__':
     add_messaging_system()
\ No newline at end of file
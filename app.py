@@ -1,13 +1,18 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, render_template, stream_template, request, redirect, url_for, flash, session, g, get_flashed_messages
 from functools import wraps
 from datetime import datetime, timedelta
 from werkzeug.utils import secure_filename
-from PIL import Image
+from werkzeug.security import generate_password_hash, check_password_hash
+from PIL import Image, ImageOps
+from concurrent.futures import ThreadPoolExecutor
 import time
 import threading
+import queue
 import sqlite3
 import hashlib
+import hmac
 import os
+import re
 
 app = Flask(__name__)
 app.secret_key = 'cellar_society_admin_secret_2024'
@@ -16,9 +21,49 @@ app.config['SESSION_COOKIE_NAME'] = 'admin_session'
 UPLOAD_FOLDER = 'static/uploads/wines'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 MAX_FILE_SIZE = 16 * 1024 * 1024
+# Files under a URL never change: uploads get a new timestamped name and the resized
+# copy is written under its own name, so served files can be cached for long
+STATIC_MAX_AGE = 30 * 24 * 60 * 60
+PER_PAGE = 50
+MAX_ROWID = 2**63 - 1
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = STATIC_MAX_AGE
+
+image_executor = ThreadPoolExecutor(max_workers=2)
+db_pool = queue.LifoQueue()
+
+SQL_UPSERT_PRODUCT = '''
+    INSERT INTO products 
+    (id, name, type, region, vintage, price, alcohol, stock, description, image_url)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET 
+        name=excluded.name, type=excluded.type, region=excluded.region, 
+        vintage=excluded.vintage, price=excluded.price, alcohol=excluded.alcohol, 
+        stock=excluded.stock, description=excluded.description, image_url=excluded.image_url
+    RETURNING id, name, type, region, vintage, price, alcohol, stock, description, image_url
+'''
+
+ADMINS_TABLE_SQL = '''CREATE TABLE IF NOT EXISTS admins (
+        username TEXT PRIMARY KEY NOT NULL,
+        password TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    ) WITHOUT ROWID'''
+
+ORDERS_COLUMNS = '''
+    SELECT order_id as id, customer_id, product_id, customer_name, customer_email,
+           product_name, product_type, quantity, total_price, status, order_date
+    FROM order_summary
+'''
+ORDERS_PAGE = ' ORDER BY order_id DESC LIMIT ?'
+
+ORDERS_QUERIES = {
+    'all': ('SELECT COUNT(*) as count FROM order_summary',
+            ORDERS_COLUMNS + ' WHERE order_id < ?' + ORDERS_PAGE),
+    'status': ('SELECT COUNT(*) as count FROM order_summary WHERE status = ?',
+               ORDERS_COLUMNS + ' WHERE status = ? AND order_id < ?' + ORDERS_PAGE),
+}
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -27,6 +72,7 @@ def save_wine_image(file):
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        # The upload keeps its real extension; the resized WebP gets its own name once written
         name, ext = os.path.splitext(filename)
         unique_filename = f"{name}_{timestamp}{ext}"
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
@@ -34,16 +80,53 @@ def save_wine_image(file):
         return f"/static/uploads/wines/{unique_filename}"
     return None
 
+def process_wine_image(product_id, image_url):
+    # Runs off the request thread. The raw upload is served until the resized WebP exists
+    # under its own name, then the product is switched over (GIFs are left alone to keep animation)
+    if image_url.lower().endswith('.gif'):
+        return
+    webp_url = os.path.splitext(image_url)[0] + '_800.webp'
+    try:
+        with Image.open('.' + image_url) as img:
+            # Lets libjpeg decode straight at a 1/2, 1/4 or 1/8 scale instead of full resolution
+            img.draft(img.mode, (800, 800))
+            # WebP output carries no EXIF, so bake the camera's orientation tag into the pixels
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((800, 800))
+            img.save('.' + webp_url, format='WEBP', quality=80, method=6)
+    except (OSError, ValueError):
+        remove_wine_image(webp_url)
+        return
+    
+    conn = get_db_connection()
+    try:
+        switched = conn.execute('UPDATE products SET image_url = ? WHERE id = ? AND image_url = ?',
+                                (webp_url, product_id, image_url)).rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    
+    if switched:
+        cached = product_cache.get(product_id)
+        if cached:
+            cached['image_url'] = webp_url
+        remove_wine_image(image_url)
+    else:
+        # The product was deleted or given another image in the meantime
+        remove_wine_image(webp_url)
+
+def remove_wine_image(image_url):
+    try:
+        os.remove('.' + image_url)
+    except OSError:
+        pass
+
 def init_db():
     conn = sqlite3.connect('cellar_society.db')
+    conn.execute('PRAGMA journal_mode=WAL')
     c = conn.cursor()
     
-    c.execute('''CREATE TABLE IF NOT EXISTS admins (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE NOT NULL,
-        password TEXT NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )''')
+    c.execute(ADMINS_TABLE_SQL)
     
     c.execute('''CREATE TABLE IF NOT EXISTS products (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -53,7 +136,7 @@ def init_db():
         vintage INTEGER NOT NULL,
         price REAL NOT NULL,
         alcohol REAL NOT NULL,
-        stock INTEGER NOT NULL,
+        stock INTEGER NOT NULL CHECK (stock >= 0),
         description TEXT,
         image_url TEXT,
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
@@ -80,155 +163,332 @@ def init_db():
         FOREIGN KEY (customer_id) REFERENCES customers(id),
         FOREIGN KEY (product_id) REFERENCES products(id)
     )''')
-    
+
     c.execute("SELECT * FROM admins WHERE username='admin'")
     if not c.fetchone():
-        hashed_pw = hashlib.sha256('admin456'.encode()).hexdigest()
+        hashed_pw = generate_password_hash('admin456')
         c.execute("INSERT INTO admins (username, password) VALUES (?, ?)", ('admin', hashed_pw))
+
+    c.execute('CREATE INDEX IF NOT EXISTS idx_orders_status_date ON orders(status, order_date DESC)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_orders_customer_date ON orders(customer_id, order_date DESC)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_orders_product ON orders(product_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_products_created ON products(created_at DESC)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_products_price ON products(price)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_customers_joined ON customers(joined_at DESC)')
+
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='customers_fts'")
+    fts_exists = c.fetchone()
+    c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS customers_fts 
+                 USING fts5(name, email, content='customers', content_rowid='id')''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS customers_fts_insert AFTER INSERT ON customers BEGIN
+        INSERT INTO customers_fts(rowid, name, email) VALUES (new.id, new.name, new.email);
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS customers_fts_delete AFTER DELETE ON customers BEGIN
+        INSERT INTO customers_fts(customers_fts, rowid, name, email) VALUES ('delete', old.id, old.name, old.email);
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS customers_fts_update AFTER UPDATE OF name, email ON customers BEGIN
+        INSERT INTO customers_fts(customers_fts, rowid, name, email) VALUES ('delete', old.id, old.name, old.email);
+        INSERT INTO customers_fts(rowid, name, email) VALUES (new.id, new.name, new.email);
+    END''')
+    if not fts_exists:
+        c.execute("INSERT INTO customers_fts(customers_fts) VALUES ('rebuild')")
     
     conn.commit()
     conn.close()
 
 def get_db_connection():
-    conn = sqlite3.connect('cellar_society.db')
+    conn = sqlite3.connect('cellar_society.db', check_same_thread=False, cached_statements=256)
     conn.row_factory = sqlite3.Row
+    # journal_mode is persistent, but the customer portal may be the first process to open the file
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA mmap_size=268435456')
+    conn.execute('PRAGMA cache_size=-64000')
     return conn
 
+def get_db():
+    # Pooled connections keep their prepared statements and page cache across requests
+    if 'db' not in g:
+        try:
+            g.db = db_pool.get_nowait()
+        except queue.Empty:
+            g.db = get_db_connection()
+    return g.db
+
+@app.teardown_appcontext
+def close_db(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        if conn.in_transaction:
+            conn.rollback()
+        db_pool.put(conn)
+
+SCHEMA_VERSION = 13
+
+def add_column(conn, table, column, definition):
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+    if column not in columns:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
 def migrate_database():
     conn = sqlite3.connect('cellar_society.db')
-    try:
-        conn.execute('ALTER TABLE orders ADD COLUMN estimated_delivery_date TEXT')
-    except sqlite3.OperationalError:
-        pass
-    
-    try:
-        conn.execute('ALTER TABLE orders ADD COLUMN shipped_date TEXT')
-    except sqlite3.OperationalError:
-        pass
-    
+    if conn.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+        conn.close()
+        return
+    
+    # All steps share one write transaction: a single journal sync, and a second
+    # process starting at the same time waits here and then sees the new version
+    conn.execute('BEGIN IMMEDIATE')
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        conn.rollback()
+        conn.close()
+        return
+    
+    if version < 1:
+        conn.execute('''CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            customer_id INTEGER NOT NULL,
+            sender_type TEXT NOT NULL,
+            message TEXT NOT NULL,
+            is_read INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (customer_id) REFERENCES customers(id)
+        )''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_messages_customer 
+                        ON messages(customer_id, created_at DESC)''')
+        add_column(conn, 'orders', 'estimated_delivery_date', 'TEXT')
+        add_column(conn, 'orders', 'shipped_date', 'TEXT')
+    
+    if version < 2:
+        admin_columns = [column[1] for column in conn.execute('PRAGMA table_info(admins)')]
+        if 'id' in admin_columns:
+            conn.execute('ALTER TABLE admins RENAME TO admins_old')
+            conn.execute(ADMINS_TABLE_SQL)
+            conn.execute('INSERT INTO admins (username, password, created_at) SELECT username, password, created_at FROM admins_old')
+            conn.execute('DROP TABLE admins_old')
+    
+    if version < 4:
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_messages_customer_unread 
+                        ON messages(customer_id, sender_type, is_read)''')
+    
+    if version < 5:
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_messages_unread 
+                        ON messages(sender_type, is_read) WHERE is_read = 0''')
+    
+    if version < 6:
+        conn.execute('''CREATE TABLE IF NOT EXISTS order_summary (
+            order_id INTEGER PRIMARY KEY,
+            customer_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            customer_name TEXT,
+            customer_email TEXT,
+            product_name TEXT,
+            product_type TEXT,
+            quantity INTEGER,
+            total_price REAL,
+            status TEXT,
+            order_date TIMESTAMP
+        )''')
+        conn.execute('''
+            INSERT OR REPLACE INTO order_summary
+            SELECT o.id, o.customer_id, o.product_id, c.name, c.email, p.name, p.type,
+                   o.quantity, o.total_price, o.status, o.order_date
+            FROM orders o
+            JOIN customers c ON o.customer_id = c.id
+            JOIN products p ON o.product_id = p.id
+        ''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_order_summary_status 
+                        ON order_summary(status)''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS order_summary_insert AFTER INSERT ON orders BEGIN
+            INSERT OR REPLACE INTO order_summary
+            SELECT new.id, new.customer_id, new.product_id, c.name, c.email, p.name, p.type,
+                   new.quantity, new.total_price, new.status, new.order_date
+            FROM customers c, products p
+            WHERE c.id = new.customer_id AND p.id = new.product_id;
+        END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS order_summary_update AFTER UPDATE OF status, quantity, total_price ON orders BEGIN
+            UPDATE order_summary 
+            SET status = new.status, quantity = new.quantity, total_price = new.total_price
+            WHERE order_id = new.id;
+        END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS order_summary_delete AFTER DELETE ON orders BEGIN
+            DELETE FROM order_summary WHERE order_id = old.id;
+        END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS order_summary_customer_update AFTER UPDATE OF name, email ON customers BEGIN
+            UPDATE order_summary SET customer_name = new.name, customer_email = new.email
+            WHERE customer_id = new.id;
+        END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS order_summary_customer_delete AFTER DELETE ON customers BEGIN
+            DELETE FROM order_summary WHERE customer_id = old.id;
+        END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS order_summary_product_update AFTER UPDATE OF name, type ON products BEGIN
+            UPDATE order_summary SET product_name = new.name, product_type = new.type
+            WHERE product_id = new.id;
+        END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS order_summary_product_delete AFTER DELETE ON products BEGIN
+            DELETE FROM order_summary WHERE product_id = old.id;
+        END''')
+    
+    if version < 7:
+        conn.execute('DROP INDEX IF EXISTS idx_messages_customer')
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_messages_customer_covering 
+                        ON messages(customer_id, created_at DESC, is_read, sender_type)''')
+    
+    if version < 9:
+        legacy_dates = conn.execute('''SELECT id, estimated_delivery_date FROM orders 
+                                       WHERE estimated_delivery_date NOT LIKE '____-__-__' ''').fetchall()
+        iso_dates = []
+        for order_id, delivery_date in legacy_dates:
+            try:
+                iso_dates.append((datetime.strptime(delivery_date, '%B %d, %Y').date().isoformat(), order_id))
+            except ValueError:
+                continue
+        conn.executemany('UPDATE orders SET estimated_delivery_date = ? WHERE id = ?', iso_dates)
+    
+    if version < 11:
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_orders_customer_status 
+                        ON orders(customer_id, status)''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_products_in_stock 
+                        ON products(type, created_at DESC) WHERE stock > 0''')
+    
+    if version < 12:
+        conn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS products_fts 
+                        USING fts5(name, region, type, content='products', content_rowid='id')''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+            INSERT INTO products_fts(rowid, name, region, type) VALUES (new.id, new.name, new.region, new.type);
+        END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+            INSERT INTO products_fts(products_fts, rowid, name, region, type) VALUES ('delete', old.id, old.name, old.region, old.type);
+        END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF name, region, type ON products BEGIN
+            INSERT INTO products_fts(products_fts, rowid, name, region, type) VALUES ('delete', old.id, old.name, old.region, old.type);
+            INSERT INTO products_fts(rowid, name, region, type) VALUES (new.id, new.name, new.region, new.type);
+        END''')
+        conn.execute("INSERT INTO products_fts(products_fts) VALUES ('rebuild')")
+    
+    if version < 13:
+        # Existing products tables predate the CHECK constraint and SQLite cannot add one in place
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS products_stock_insert_check BEFORE INSERT ON products
+                        WHEN new.stock < 0 BEGIN SELECT RAISE(ABORT, 'stock cannot be negative'); END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS products_stock_update_check BEFORE UPDATE OF stock ON products
+                        WHEN new.stock < 0 BEGIN SELECT RAISE(ABORT, 'stock cannot be negative'); END''')
+    
+    # Refresh sqlite_stat1 whenever the schema changes so the planner sees the new indexes
+    conn.execute('ANALYZE')
+    conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
     conn.commit()
     conn.close()
 
-class ProductHashTable:
-    def __init__(self):
-        self.table = {}
-    
-    def insert(self, product_id, product_data):
-        self.table[product_id] = product_data
-    
-    def get(self, product_id):
-        return self.table.get(product_id, None)
-    
-    def delete(self, product_id):
-        if product_id in self.table:
-            del self.table[product_id]
-            return True
-        return False
-    
-    def get_all(self):
-        return list(self.table.values())
-
-product_cache = ProductHashTable()
+# Maps product id -> product data, kept current by the add/edit/delete routes
+product_cache = {}
+
+STAT_KEYS = ('total_products', 'total_customers', 'total_orders',
+             'pending_orders', 'processing_orders', 'unread_messages')
+
+class StatsCache:
+    def __init__(self, ttl=10):
+        # Writes made by the customer portal run in another process, so cached
+        # counts also expire after ttl seconds
+        self.ttl = ttl
+        self.stats = {}
+        self.expires_at = 0
+        self.lock = threading.Lock()
+    
+    def get(self, conn):
+        with self.lock:
+            now = time.time()
+            if now >= self.expires_at:
+                self.stats = {}
+                self.expires_at = now + self.ttl
+            
+            if any(key not in self.stats for key in STAT_KEYS):
+                counts = conn.execute('''
+                    SELECT
+                        (SELECT COUNT(*) FROM products) as total_products,
+                        (SELECT COUNT(*) FROM customers) as total_customers,
+                        (SELECT COUNT(*) FROM orders) as total_orders,
+                        (SELECT COUNT(*) FROM orders WHERE status = 'Pending') as pending_orders,
+                        (SELECT COUNT(*) FROM orders WHERE status = 'Processing') as processing_orders,
+                        (SELECT COUNT(*) FROM messages WHERE sender_type = 'customer' AND is_read = 0) as unread_messages
+                ''').fetchone()
+                for key in counts.keys():
+                    self.stats.setdefault(key, counts[key])
+            
+            return dict(self.stats)
+    
+    def invalidate(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.stats.pop(key, None)
+
+stats_cache = StatsCache()
+
+def bump_order_stats():
+    stats_cache.invalidate('total_orders', 'pending_orders', 'processing_orders')
 
 def load_products_to_cache():
+    global product_cache
     conn = sqlite3.connect('cellar_society.db')
     c = conn.cursor()
-    c.execute("SELECT * FROM products")
-    products = c.fetchall()
+    c.execute('''
+        SELECT id, name, type, region, vintage, price, alcohol, stock, description, image_url 
+        FROM products
+    ''')
+    # Plain tuples zipped against the column names skip the per-row sqlite3.Row objects
+    columns = [column[0] for column in c.description]
+    new_table = {p[0]: dict(zip(columns, p)) for p in c}
     conn.close()
-    
-    product_cache.table.clear()
-    
-    for p in products:
-        product_data = {
-            'id': p[0],
-            'name': p[1],
-            'type': p[2],
-            'region': p[3],
-            'vintage': p[4],
-            'price': p[5],
-            'alcohol': p[6],
-            'stock': p[7],
-            'description': p[8],
-            'image_url': p[9]
-        }
-        product_cache.insert(p[0], product_data)
-
-class Node:
-    def __init__(self, product):
-        self.product = product
-        self.left = None
-        self.right = None
-
-class ProductBST:
-    def __init__(self):
-        self.root = None
-    
-    def insert(self, product):
-        if not self.root:
-            self.root = Node(product)
-        else:
-            self._insert_recursive(self.root, product)
-    
-    def _insert_recursive(self, node, product):
-        if product['price'] < node.product['price']:
-            if node.left is None:
-                node.left = Node(product)
-            else:
-                self._insert_recursive(node.left, product)
-        else:
-            if node.right is None:
-                node.right = Node(product)
-            else:
-                self._insert_recursive(node.right, product)
-    
-    def search_by_price_range(self, min_price, max_price):
-        results = []
-        self._range_search(self.root, min_price, max_price, results)
-        return results
-    
-    def _range_search(self, node, min_price, max_price, results):
-        if node is None:
-            return
-        
-        if min_price <= node.product['price'] <= max_price:
-            results.append(node.product)
-        
-        if min_price < node.product['price']:
-            self._range_search(node.left, min_price, max_price, results)
-        
-        if max_price > node.product['price']:
-            self._range_search(node.right, min_price, max_price, results)
+    # Rebind to a fully built dict so readers never see a half-loaded cache
+    product_cache = new_table
+
+def search_by_price_range(min_price, max_price):
+    conn = get_db()
+    return conn.execute('''
+        SELECT * FROM products 
+        WHERE price BETWEEN ? AND ?
+        ORDER BY price
+    ''', (min_price, max_price)).fetchall()
+
+def verify_password(stored_hash, password):
+    # Accounts created before the KDF switch still hold a bare SHA-256 hex digest
+    if ':' not in stored_hash:
+        legacy_hash = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(stored_hash, legacy_hash)
+    return check_password_hash(stored_hash, password)
+
+def fts_query(text):
+    # Quote each word so user input cannot inject FTS5 syntax; * makes it a prefix match
+    return ' '.join(f'"{term}"*' for term in re.findall(r'\w+', text))
+
+def get_page():
+    return max(request.args.get('page', 1, type=int), 1)
+
+def get_before_id():
+    return request.args.get('before', type=int)
+
+def stream_page(template_name, **context):
+    # The session cookie is written before a streamed body renders, so pop the
+    # flashes now or they would be shown again on the next page
+    get_flashed_messages()
+    return stream_template(template_name, **context)
 
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'admin_id' not in session:
+        if 'admin_username' not in session:
             flash('Please login first', 'error')
             return redirect(url_for('login'))
         return f(*args, **kwargs)
     return decorated_function
 
 def get_admin_notification_counts():
-    conn = get_db_connection()
-    
-    pending_orders = conn.execute('''
-        SELECT COUNT(*) as count FROM orders 
-        WHERE status = 'Pending'
-    ''').fetchone()['count']
-    
-    processing_orders = conn.execute('''
-        SELECT COUNT(*) as count FROM orders 
-        WHERE status = 'Processing'
-    ''').fetchone()['count']
-    
-    unread_messages = conn.execute('''
-        SELECT COUNT(*) as count FROM messages 
-        WHERE sender_type = 'customer' AND is_read = 0
-    ''').fetchone()['count']
-    
-    conn.close()
+    stats = stats_cache.get(get_db())
     
+    pending_orders = stats['pending_orders']
+    processing_orders = stats['processing_orders']
+    unread_messages = stats['unread_messages']
     total = pending_orders + processing_orders + unread_messages
     
     return {
@@ -246,7 +506,7 @@ def inject_admin_notifications():
 
 @app.route('/')
 def index():
-    if 'admin_id' in session:
+    if 'admin_username' in session:
         return redirect(url_for('dashboard'))
     return redirect(url_for('login'))
 
@@ -255,17 +515,19 @@ def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        hashed_pw = hashlib.sha256(password.encode()).hexdigest()
         
-        conn = get_db_connection()
+        conn = get_db()
         admin = conn.execute(
-            'SELECT * FROM admins WHERE username = ? AND password = ?',
-            (username, hashed_pw)
+            'SELECT username, password FROM admins WHERE username = ?',
+            (username,)
         ).fetchone()
-        conn.close()
         
-        if admin:
-            session['admin_id'] = admin['id']
+        if admin and verify_password(admin['password'], password):
+            if ':' not in admin['password']:
+                conn.execute('UPDATE admins SET password = ? WHERE username = ?',
+                             (generate_password_hash(password), admin['username']))
+                conn.commit()
+
             session['admin_username'] = admin['username']
             flash(f'Welcome back, {username}!', 'success')
             return redirect(url_for('dashboard'))
@@ -283,49 +545,45 @@ def logout():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    conn = get_db_connection()
-    
-    total_products = conn.execute('SELECT COUNT(*) as count FROM products').fetchone()['count']
-    total_customers = conn.execute('SELECT COUNT(*) as count FROM customers').fetchone()['count']
-    total_orders = conn.execute('SELECT COUNT(*) as count FROM orders').fetchone()['count']
-    pending_orders = conn.execute('SELECT COUNT(*) as count FROM orders WHERE status = "Pending"').fetchone()['count']
-    processing_orders = conn.execute('SELECT COUNT(*) as count FROM orders WHERE status = "Processing"').fetchone()['count']
-    unread_messages = conn.execute('''
-        SELECT COUNT(*) as count FROM messages 
-        WHERE sender_type = 'customer' AND is_read = 0
-    ''').fetchone()['count']
+    conn = get_db()
+    stats = stats_cache.get(conn)
 
-    recent_orders = conn.execute('''
-        SELECT o.id, c.name as customer_name, p.name as product_name, 
-               o.quantity, o.total_price, o.status, o.order_date
-        FROM orders o
-        JOIN customers c ON o.customer_id = c.id
-        JOIN products p ON o.product_id = p.id
-        ORDER BY o.order_date DESC
-        LIMIT 5
-    ''').fetchall()
-    
-    conn.close()
-    
-    stats = {
-        'total_products': total_products,
-        'total_customers': total_customers,
-        'total_orders': total_orders,
-        'pending_orders': pending_orders,
-        'processing_orders': processing_orders,
-        'unread_messages': unread_messages
-    }
+    recent_orders = conn.execute(ORDERS_COLUMNS + ORDERS_PAGE, (5,)).fetchall()
     
     return render_template('admin/dashboard.html', stats=stats, recent_orders=recent_orders)
 
 @app.route('/products')
 @login_required
 def products():
-    conn = get_db_connection()
-    products = conn.execute('SELECT * FROM products ORDER BY created_at DESC').fetchall()
-    conn.close()
+    search = request.args.get('search', '')
+    wine_type = request.args.get('type', '')
+    page = get_page()
+    conn = get_db()
+    conditions = []
+    params = []
+    
+    if wine_type:
+        conditions.append('type = ?')
+        params.append(wine_type)
+    
+    match = fts_query(search)
+    if match:
+        conditions.append('id IN (SELECT rowid FROM products_fts WHERE products_fts MATCH ?)')
+        params.append(match)
+    
+    where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+    total = conn.execute('SELECT COUNT(*) as count FROM products' + where, params).fetchone()['count']
+    products = conn.execute('SELECT * FROM products' + where + ' ORDER BY created_at DESC LIMIT ? OFFSET ?',
+                            params + [PER_PAGE, (page - 1) * PER_PAGE])
+    return stream_page('admin/products.html', products=products, search=search, wine_type=wine_type, total=total,
+                       page=page, per_page=PER_PAGE, page_args={'search': search, 'type': wine_type})
+
+@app.route('/products/refresh', methods=['POST'])
+@login_required
+def refresh_products():
     load_products_to_cache()
-    return render_template('admin/products.html', products=products)
+    flash('Product cache reloaded', 'success')
+    return redirect(url_for('products'))
 
 @app.route('/products/add', methods=['GET', 'POST'])
 @login_required
@@ -340,6 +598,10 @@ def add_product():
         stock = int(request.form['stock'])
         description = request.form.get('description', '')
         
+        if stock < 0:
+            flash('Stock cannot be negative', 'error')
+            return redirect(url_for('add_product'))
+        
         image_url = ''
         if 'wine_image' in request.files:
             file = request.files['wine_image']
@@ -351,31 +613,13 @@ def add_product():
                     flash('Invalid image file format', 'error')
                     return redirect(url_for('add_product'))
         
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute('''
-            INSERT INTO products 
-            (name, type, region, vintage, price, alcohol, stock, description, image_url)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (name, wine_type, region, vintage, price, alcohol, stock, description, image_url))
-        
+        conn = get_db()
+        product = conn.execute(SQL_UPSERT_PRODUCT, (None, name, wine_type, region, vintage, price, alcohol, stock, description, image_url)).fetchone()
         conn.commit()
-        product_id = c.lastrowid
-        conn.close()
-        
-        product_data = {
-            'id': product_id,
-            'name': name,
-            'type': wine_type,
-            'region': region,
-            'vintage': vintage,
-            'price': price,
-            'alcohol': alcohol,
-            'stock': stock,
-            'description': description,
-            'image_url': image_url
-        }
-        product_cache.insert(product_id, product_data)
+        product_cache[product['id']] = dict(product)
+        stats_cache.invalidate('total_products')
+        if image_url:
+            image_executor.submit(process_wine_image, product['id'], image_url)
         
         flash(f'Wine "{name}" added successfully!', 'success')
         return redirect(url_for('products'))
@@ -385,7 +629,7 @@ def add_product():
 @app.route('/products/edit/<int:product_id>', methods=['GET', 'POST'])
 @login_required
 def edit_product(product_id):
-    conn = get_db_connection()
+    conn = get_db()
     
     if request.method == 'POST':
         name = request.form['name']
@@ -397,37 +641,38 @@ def edit_product(product_id):
         stock = int(request.form['stock'])
         description = request.form.get('description', '')
         
+        if stock < 0:
+            flash('Stock cannot be negative', 'error')
+            return redirect(url_for('edit_product', product_id=product_id))
+        
         current_product = conn.execute('SELECT image_url FROM products WHERE id = ?', (product_id,)).fetchone()
-        image_url = current_product['image_url'] if current_product else ''
+        
+        if not current_product:
+            flash('Product not found', 'error')
+            return redirect(url_for('products'))
+        
+        image_url = current_product['image_url']
+        old_image_url = None
         
         if 'wine_image' in request.files:
             file = request.files['wine_image']
             if file and file.filename:
                 saved_path = save_wine_image(file)
                 if saved_path:
-                    if image_url and os.path.exists('.' + image_url):
-                        try:
-                            os.remove('.' + image_url)
-                        except:
-                            pass
+                    old_image_url = image_url
                     image_url = saved_path
         
-        conn.execute('''
-            UPDATE products 
-            SET name=?, type=?, region=?, vintage=?, price=?, 
-                alcohol=?, stock=?, description=?, image_url=?
-            WHERE id=?
-        ''', (name, wine_type, region, vintage, price, alcohol, stock, description, image_url, product_id))
-        
+        product = conn.execute(SQL_UPSERT_PRODUCT, (product_id, name, wine_type, region, vintage, price, alcohol, stock, description, image_url)).fetchone()
         conn.commit()
-        conn.close()
-        load_products_to_cache()
+        product_cache[product_id] = dict(product)
+        if old_image_url:
+            image_executor.submit(remove_wine_image, old_image_url)
+            image_executor.submit(process_wine_image, product_id, image_url)
         
         flash(f'Wine "{name}" updated successfully!', 'success')
         return redirect(url_for('products'))
     
     product = conn.execute('SELECT * FROM products WHERE id = ?', (product_id,)).fetchone()
-    conn.close()
     
     if not product:
         flash('Product not found', 'error')
@@ -438,55 +683,53 @@ def edit_product(product_id):
 @app.route('/products/delete/<int:product_id>', methods=['POST'])
 @login_required
 def delete_product(product_id):
-    conn = get_db_connection()
+    conn = get_db()
     
     product = conn.execute('SELECT name, image_url FROM products WHERE id = ?', (product_id,)).fetchone()
     
     if product:
-        if product['image_url'] and os.path.exists('.' + product['image_url']):
-            try:
-                os.remove('.' + product['image_url'])
-            except:
-                pass
-        
         conn.execute('DELETE FROM products WHERE id = ?', (product_id,))
         conn.commit()
-        product_cache.delete(product_id)
+        product_cache.pop(product_id, None)
+        if product['image_url']:
+            image_executor.submit(remove_wine_image, product['image_url'])
+        stats_cache.invalidate('total_products')
         flash(f'Wine "{product["name"]}" deleted successfully!', 'success')
     else:
         flash('Product not found', 'error')
     
-    conn.close()
     return redirect(url_for('products'))
 
 @app.route('/customers')
 @login_required
 def customers():
     search = request.args.get('search', '')
-    conn = get_db_connection()
-    query = 'SELECT * FROM customers WHERE 1=1'
+    before = get_before_id()
+    conn = get_db()
+    source = ' FROM customers c'
     params = []
     
-    if search:
-        query += ' AND (name LIKE ? OR email LIKE ?)'
-        params.extend([f'%{search}%', f'%{search}%'])
+    match = fts_query(search)
+    if match:
+        source += ' JOIN customers_fts f ON c.id = f.rowid WHERE customers_fts MATCH ?'
+        params.append(match)
     
-    query += ' ORDER BY joined_at DESC'
-    customers = conn.execute(query, params).fetchall()
-    conn.close()
+    total = conn.execute('SELECT COUNT(*) as count' + source, params).fetchone()['count']
+    query = 'SELECT c.*' + source + (' AND' if match else ' WHERE') + ' c.id < ? ORDER BY c.id DESC LIMIT ?'
+    customers = conn.execute(query, params + [before or MAX_ROWID, PER_PAGE])
     
-    return render_template('admin/customers.html', customers=customers, search=search)
+    return stream_page('admin/customers.html', customers=customers, search=search, total=total,
+                       before=before, per_page=PER_PAGE, page_args={'search': search})
 
 @app.route('/customers/<int:customer_id>')
 @login_required
 def customer_detail(customer_id):
-    conn = get_db_connection()
+    conn = get_db()
     
     customer = conn.execute('SELECT * FROM customers WHERE id = ?', (customer_id,)).fetchone()
     
     if not customer:
         flash('Customer not found', 'error')
-        conn.close()
         return redirect(url_for('customers'))
     
     orders = conn.execute('''
@@ -497,40 +740,32 @@ def customer_detail(customer_id):
         ORDER BY o.order_date DESC
     ''', (customer_id,)).fetchall()
     
-    conn.close()
-    
     return render_template('admin/customer_detail.html', customer=customer, orders=orders)
 
 @app.route('/orders')
 @login_required
 def orders():
     status_filter = request.args.get('status', '')
-    conn = get_db_connection()
-    
-    query = '''
-        SELECT o.*, c.name as customer_name, c.email as customer_email,
-               p.name as product_name, p.type as product_type
-        FROM orders o
-        JOIN customers c ON o.customer_id = c.id
-        JOIN products p ON o.product_id = p.id
-        WHERE 1=1
-    '''
-    params = []
+    before = get_before_id()
+    conn = get_db()
     
     if status_filter:
-        query += ' AND o.status = ?'
-        params.append(status_filter)
+        count_sql, list_sql = ORDERS_QUERIES['status']
+        params = [status_filter]
+    else:
+        count_sql, list_sql = ORDERS_QUERIES['all']
+        params = []
     
-    query += ' ORDER BY o.order_date DESC'
-    orders = conn.execute(query, params).fetchall()
-    conn.close()
+    total = conn.execute(count_sql, params).fetchone()['count']
+    orders = conn.execute(list_sql, params + [before or MAX_ROWID, PER_PAGE])
     
-    return render_template('admin/orders.html', orders=orders, status_filter=status_filter)
+    return stream_page('admin/orders.html', orders=orders, status_filter=status_filter, total=total,
+                       before=before, per_page=PER_PAGE, page_args={'status': status_filter})
 
 @app.route('/orders/<int:order_id>')
 @login_required
 def order_detail(order_id):
-    conn = get_db_connection()
+    conn = get_db()
     
     order = conn.execute('''
         SELECT o.*, 
@@ -544,14 +779,17 @@ def order_detail(order_id):
         WHERE o.id = ?
     ''', (order_id,)).fetchone()
     
-    conn.close()
-    
     if not order:
         flash('Order not found', 'error')
         return redirect(url_for('orders'))
     
     return render_template('admin/order_detail.html', order=order)
 
+def shipping_dates():
+    # Stored as ISO dates so they sort and compare correctly; templates format them for display
+    now = datetime.now()
+    return now.date().isoformat(), (now + timedelta(days=4)).date().isoformat()
+
 @app.route('/orders/update-status/<int:order_id>', methods=['POST'])
 @login_required
 def update_order_status(order_id):
@@ -562,32 +800,27 @@ def update_order_status(order_id):
         flash('Invalid status', 'error')
         return redirect(url_for('orders'))
     
-    conn = get_db_connection()
-    order = conn.execute('SELECT * FROM orders WHERE id = ?', (order_id,)).fetchone()
-    
-    if not order:
-        flash('Order not found', 'error')
-        conn.close()
-        return redirect(url_for('orders'))
-    
     estimated_delivery = None
     shipped_date = None
     
     if new_status == 'Processing':
-        shipped_date = datetime.now().strftime('%Y-%m-%d')
-        estimated_delivery = (datetime.now() + timedelta(days=4)).strftime('%B %d, %Y')
+        shipped_date, estimated_delivery = shipping_dates()
+    
+    conn = get_db()
+    updated = conn.execute('''
+        UPDATE orders 
+        SET status = ?, 
+            estimated_delivery_date = COALESCE(?, estimated_delivery_date), 
+            shipped_date = COALESCE(?, shipped_date)
+        WHERE id = ?
+    ''', (new_status, estimated_delivery, shipped_date, order_id)).rowcount
+    conn.commit()
     
-    if estimated_delivery:
-        conn.execute('''
-            UPDATE orders 
-            SET status = ?, estimated_delivery_date = ?, shipped_date = ?
-            WHERE id = ?
-        ''', (new_status, estimated_delivery, shipped_date, order_id))
-    else:
-        conn.execute('UPDATE orders SET status = ? WHERE id = ?', (new_status, order_id))
+    if not updated:
+        flash('Order not found', 'error')
+        return redirect(url_for('orders'))
     
-    conn.commit()
-    conn.close()
+    bump_order_stats()
     
     flash(f'Order #{order_id} status updated to {new_status}', 'success')
     return redirect(url_for('orders'))
@@ -595,35 +828,32 @@ def update_order_status(order_id):
 @app.route('/messages')
 @login_required
 def messages():
-    conn = get_db_connection()
+    conn = get_db()
     
     customers_with_messages = conn.execute('''
         SELECT 
             c.id,
             c.name,
             c.email,
-            COUNT(CASE WHEN m.is_read = 0 AND m.sender_type = 'customer' THEN 1 END) as unread_count,
-            MAX(m.created_at) as last_message_time
+            (SELECT COUNT(*) FROM messages m 
+             WHERE m.customer_id = c.id AND m.sender_type = 'customer' AND m.is_read = 0) as unread_count,
+            (SELECT MAX(m.created_at) FROM messages m WHERE m.customer_id = c.id) as last_message_time
         FROM customers c
-        INNER JOIN messages m ON c.id = m.customer_id
-        GROUP BY c.id, c.name, c.email
+        WHERE EXISTS (SELECT 1 FROM messages m WHERE m.customer_id = c.id)
         ORDER BY last_message_time DESC
     ''').fetchall()
     
-    conn.close()
-    
     return render_template('admin/messages.html', customers=customers_with_messages)
 
 @app.route('/messages/<int:customer_id>')
 @login_required
 def message_thread(customer_id):
-    conn = get_db_connection()
+    conn = get_db()
     
     customer = conn.execute('SELECT * FROM customers WHERE id = ?', (customer_id,)).fetchone()
     
     if not customer:
         flash('Customer not found', 'error')
-        conn.close()
         return redirect(url_for('messages'))
     
     messages = conn.execute('''
@@ -632,14 +862,15 @@ def message_thread(customer_id):
         ORDER BY created_at ASC
     ''', (customer_id,)).fetchall()
     
-    conn.execute('''
-        UPDATE messages 
-        SET is_read = 1
-        WHERE customer_id = ? AND sender_type = 'customer' AND is_read = 0
-    ''', (customer_id,))
-    
-    conn.commit()
-    conn.close()
+    unread = sum(1 for m in messages if m['sender_type'] == 'customer' and m['is_read'] == 0)
+    if unread:
+        with conn:
+            conn.execute('''
+                UPDATE messages 
+                SET is_read = 1
+                WHERE customer_id = ? AND sender_type = 'customer' AND is_read = 0
+            ''', (customer_id,))
+        stats_cache.invalidate('unread_messages')
     
     return render_template('admin/message_thread.html', customer=customer, messages=messages)
 
@@ -656,12 +887,11 @@ def send_message_to_customer(customer_id):
         flash('Message is too long (max 1000 characters)', 'error')
         return redirect(url_for('message_thread', customer_id=customer_id))
     
-    conn = get_db_connection()
+    conn = get_db()
     customer = conn.execute('SELECT * FROM customers WHERE id = ?', (customer_id,)).fetchone()
     
     if not customer:
         flash('Customer not found', 'error')
-        conn.close()
         return redirect(url_for('messages'))
     
     conn.execute('''
@@ -670,26 +900,25 @@ def send_message_to_customer(customer_id):
     ''', (customer_id, message_text))
     
     conn.commit()
-    conn.close()
     
     flash('Message sent successfully!', 'success')
     return redirect(url_for('message_thread', customer_id=customer_id))
 
 def get_total_unread_messages():
-    conn = get_db_connection()
+    conn = get_db()
     count = conn.execute('''
         SELECT COUNT(*) as count FROM messages 
         WHERE sender_type = 'customer' AND is_read = 0
     ''').fetchone()['count']
-    conn.close()
     return count
 
 def auto_process_orders():
+    # The worker keeps one connection for its whole lifetime
+    conn = get_db_connection()
+
     while True:
         time.sleep(5)  # check every 5 seconds
 
-        conn = get_db_connection()
-
         # Get next pending order
         pending = conn.execute('''
             SELECT id FROM orders 
@@ -702,8 +931,7 @@ def auto_process_orders():
             order_id = pending['id']
             print(f"[AUTO] Processing Order #{order_id} -> Processing")
 
-            shipped_date = datetime.now().strftime('%Y-%m-%d')
-            estimated_delivery = (datetime.now() + timedelta(days=4)).strftime('%B %d, %Y')
+            shipped_date, estimated_delivery = shipping_dates()
 
             # Status → Processing
             conn.execute('''
@@ -714,6 +942,7 @@ def auto_process_orders():
                 WHERE id = ?
             ''', (shipped_date, estimated_delivery, order_id))
             conn.commit()
+            bump_order_stats()
 
             time.sleep(5)
 
@@ -721,6 +950,7 @@ def auto_process_orders():
             print(f"[AUTO] Order #{order_id} -> Delivered")
             conn.execute('UPDATE orders SET status = "Delivered" WHERE id = ?', (order_id,))
             conn.commit()
+            bump_order_stats()
 
             time.sleep(5)
 
@@ -731,8 +961,6 @@ def auto_process_orders():
 
             print(f"[AUTO] ✅ Order #{order_id} fully completed.\n")
 
-        conn.close()
-
 def start_auto_processing():
     t = threading.Thread(target=auto_process_orders, daemon=True)
     t.start()
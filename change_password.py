@@ -1,6 +1,6 @@
 
 import sqlite3
-import hashlib
+from werkzeug.security import generate_password_hash
 
 def change_admin_password():
     
@@ -28,7 +28,7 @@ def change_admin_password():
         return
 
     # Hash the new password
-    hashed_password = hashlib.sha256(new_password.encode()).hexdigest()
+    hashed_password = generate_password_hash(new_password)
     
     # Update database
     try:
@@ -1,36 +1,34 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, render_template, request, redirect, url_for, flash, session, g
 from functools import wraps
 from datetime import datetime, timedelta
 from collections import deque
+from app import migrate_database, get_db, close_db, stream_page, verify_password, fts_query, STATIC_MAX_AGE
+from werkzeug.security import generate_password_hash
 import sqlite3
-import hashlib
+import threading
+import time
 import os
+import random
 
 app = Flask(__name__)
 app.secret_key = 'cellar_society_customer_secret_2024'
 app.config['SESSION_COOKIE_NAME'] = 'customer_session'
-
-def get_db_connection():
-    conn = sqlite3.connect('cellar_society.db')
-    conn.row_factory = sqlite3.Row
-    return conn
-
-def migrate_database():
-    conn = get_db_connection()
-    try:
-        conn.execute('ALTER TABLE orders ADD COLUMN estimated_delivery_date TEXT')
-        print("✅ Added estimated_delivery_date column")
-    except sqlite3.OperationalError:
-        pass
-    
-    try:
-        conn.execute('ALTER TABLE orders ADD COLUMN shipped_date TEXT')
-        print("✅ Added shipped_date column")
-    except sqlite3.OperationalError:
-        pass
-    
-    conn.commit()
-    conn.close()
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = STATIC_MAX_AGE
+
+# Both histories ride in the session cookie, so keep only what the pages display
+MAX_BROWSING_HISTORY = 10
+MAX_SEARCH_HISTORY = 5
+SHOP_PER_PAGE = 40
+# Listing columns; description and created_at are only needed on the product page
+PRODUCT_CARD_COLUMNS = 'id, name, type, region, vintage, price, alcohol, stock, image_url'
+SHOP_ORDER_BY = {
+    'newest': ' ORDER BY created_at DESC',
+    'price_low': ' ORDER BY price ASC',
+    'price_high': ' ORDER BY price DESC',
+    'name': ' ORDER BY name ASC',
+}
+
+app.teardown_appcontext(close_db)
 
 class CategoryHashTable:
     def __init__(self):
@@ -169,9 +167,42 @@ class ShoppingCart:
     def clear(self):
         self.cart.clear()
 
+class TTLCache:
+    def __init__(self, ttl=10, max_size=256):
+        # Other processes write the same tables, so entries also expire after ttl seconds
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = {}
+        self.lock = threading.Lock()
+    
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.time():
+                return entry[1]
+            return None
+    
+    def set(self, key, value):
+        with self.lock:
+            if len(self.entries) >= self.max_size:
+                self.entries.pop(next(iter(self.entries)))
+            self.entries[key] = (time.time() + self.ttl, value)
+    
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
 order_queue = OrderQueue()
 browsing_history = BrowsingHistory()
 search_history = SearchHistory()
+shop_cache = TTLCache()
+# Keyed by customer id; dropped by the customer routes that change a badge,
+# admin-side changes show up when the entry expires
+notification_cache = TTLCache(ttl=10, max_size=1024)
 
 def login_required(f):
     @wraps(f)
@@ -182,38 +213,87 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-def get_cart():
-    if 'cart' not in session:
-        session['cart'] = {}
-    return session['cart']
+def get_cart(key='cart'):
+    # The session cookie only carries product id -> quantity; carts saved by older
+    # versions still hold whole product dicts
+    cart = session.get(key, {})
+    return {product_id: item['quantity'] if isinstance(item, dict) else item for product_id, item in cart.items()}
 
 def save_cart(cart_dict):
-    session['cart'] = cart_dict
-    session.modified = True
+    # Only a real change should re-sign the session cookie
+    if session.get('cart') != cart_dict:
+        session['cart'] = cart_dict
+        g.pop('cart_count', None)
 
-def get_cart_total():
-    cart = get_cart()
-    total = 0
-    for item in cart.values():
-        total += item['price'] * item['quantity']
-    return total
+def load_cart_items(cart):
+    if not cart:
+        return {}
+    placeholders = ','.join('?' * len(cart))
+    products = {str(product['id']): product for product in get_db().execute(
+        f'SELECT id, name, price, image_url, stock FROM products WHERE id IN ({placeholders})', list(cart))}
+    return {product_id: dict(products[product_id], quantity=quantity)
+            for product_id, quantity in cart.items() if product_id in products}
+
+def get_cart_total(items):
+    return sum(item['price'] * item['quantity'] for item in items.values())
 
 def get_cart_count():
-    cart = get_cart()
-    return sum(item['quantity'] for item in cart.values())
+    if 'cart_count' not in g:
+        g.cart_count = sum(get_cart().values())
+    return g.cart_count
+
+def place_orders(conn, customer_id, items):
+    order_rows = []
+    stock_rows = []
+    for item in items:
+        order_rows.append((customer_id, item['id'], item['quantity'], item['price'] * item['quantity'], 'Pending'))
+        stock_rows.append((item['quantity'], item['id'], item['quantity']))
+    
+    # Take the write lock up front so concurrent checkouts queue on busy_timeout instead of failing mid-transaction.
+    # The stock guard makes the decrement atomic; if any line no longer fits, nothing is ordered
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        updated = conn.executemany('UPDATE products SET stock = stock - ? WHERE id = ? AND stock >= ?', stock_rows).rowcount
+    except sqlite3.IntegrityError:
+        updated = -1
+    if updated != len(stock_rows):
+        conn.rollback()
+        return False
+    
+    conn.executemany('INSERT INTO orders (customer_id, product_id, quantity, total_price, status) VALUES (?, ?, ?, ?, ?)', order_rows)
+    conn.commit()
+    shop_cache.clear()
+    notification_cache.discard(customer_id)
+    
+    for order in order_rows:
+        order_queue.enqueue(dict(zip(('customer_id', 'product_id', 'quantity', 'total_price', 'status'), order)))
+    return True
 
 def get_notification_counts():
     if 'customer_id' not in session:
         return {'orders_to_pay': 0, 'orders_to_receive': 0, 'unread_messages': 0, 'total': 0}
     
-    conn = get_db_connection()
-    orders_to_pay = conn.execute('SELECT COUNT(*) as count FROM orders WHERE customer_id = ? AND status = "Pending"', (session['customer_id'],)).fetchone()['count']
-    orders_to_receive = conn.execute('SELECT COUNT(*) as count FROM orders WHERE customer_id = ? AND status = "Delivered"', (session['customer_id'],)).fetchone()['count']
+    cached = notification_cache.get(session['customer_id'])
+    if cached:
+        return cached
+    
+    conn = get_db()
+    order_counts = dict(conn.execute("SELECT status, COUNT(*) FROM orders WHERE customer_id = ? AND status IN ('Pending', 'Delivered') GROUP BY status", (session['customer_id'],)).fetchall())
+    orders_to_pay = order_counts.get('Pending', 0)
+    orders_to_receive = order_counts.get('Delivered', 0)
     unread_messages = conn.execute('SELECT COUNT(*) as count FROM messages WHERE customer_id = ? AND sender_type = "admin" AND is_read = 0', (session['customer_id'],)).fetchone()['count']
-    conn.close()
     
     total = orders_to_pay + orders_to_receive + unread_messages
-    return {'orders_to_pay': orders_to_pay, 'orders_to_receive': orders_to_receive, 'unread_messages': unread_messages, 'total': total}
+    counts = {'orders_to_pay': orders_to_pay, 'orders_to_receive': orders_to_receive, 'unread_messages': unread_messages, 'total': total}
+    notification_cache.set(session['customer_id'], counts)
+    return counts
+
+@app.template_filter('display_date')
+def display_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').strftime('%B %d, %Y')
+    except (TypeError, ValueError):
+        return value
 
 @app.context_processor
 def inject_notifications():
@@ -221,7 +301,7 @@ def inject_notifications():
 
 @app.route('/')
 def index():
-    return render_template('customer/landing.html', cart_count=get_cart_count())
+    return render_template('customer/landing.html')
 
 @app.route('/shop')
 def shop():
@@ -234,76 +314,78 @@ def shop():
             session['search_history'] = []
         history = session['search_history']
         search_lower = search.strip().lower()
-        if search_lower in history:
-            history.remove(search_lower)
-        history.append(search_lower)
-        if len(history) > 10:
-            history = history[-10:]
-        session['search_history'] = history
-        session.modified = True
-    
-    conn = get_db_connection()
-    query = 'SELECT * FROM products WHERE stock > 0'
-    params = []
-    
-    if wine_type:
-        query += ' AND type = ?'
-        params.append(wine_type)
-    
-    if search:
-        query += ' AND (name LIKE ? OR region LIKE ? OR type LIKE ?)'
-        params.extend([f'%{search}%', f'%{search}%', f'%{search}%'])
-    
-    if sort == 'price_low':
-        query += ' ORDER BY price ASC'
-    elif sort == 'price_high':
-        query += ' ORDER BY price DESC'
-    elif sort == 'name':
-        query += ' ORDER BY name ASC'
+        if not history or history[-1] != search_lower:
+            if search_lower in history:
+                history.remove(search_lower)
+            history.append(search_lower)
+            if len(history) > MAX_SEARCH_HISTORY:
+                history = history[-MAX_SEARCH_HISTORY:]
+            session['search_history'] = history
+            session.modified = True
+    
+    page = max(request.args.get('page', 1, type=int), 1)
+    conn = get_db()
+    cache_key = (wine_type, search, sort, page)
+    cached = shop_cache.get(cache_key)
+    
+    if cached:
+        products, category_stats, total = cached
     else:
-        query += ' ORDER BY created_at DESC'
-    
-    products = conn.execute(query, params).fetchall()
-    products_list = [dict(p) for p in products]
-
-    # Organize using hash table
-    category_table.organize_products(products_list)
-
-    # Fetch statistics
-    category_stats = category_table.get_statistics()
-
-    recommendations = conn.execute('SELECT * FROM products WHERE stock > 0 ORDER BY RANDOM() LIMIT 6').fetchall()
-    conn.close()
+        where = ' WHERE stock > 0'
+        params = []
+        
+        if wine_type:
+            where += ' AND type = ?'
+            params.append(wine_type)
+        
+        match = fts_query(search)
+        if match:
+            where += ' AND id IN (SELECT rowid FROM products_fts WHERE products_fts MATCH ?)'
+            params.append(match)
+        
+        # Category counts cover every match, not just the page shown
+        category_stats = dict.fromkeys(category_table.get_all_categories(), 0)
+        category_stats.update(conn.execute('SELECT type, COUNT(*) FROM products' + where + ' GROUP BY type', params).fetchall())
+        total = sum(category_stats.values())
+        
+        query = f'SELECT {PRODUCT_CARD_COLUMNS} FROM products' + where + SHOP_ORDER_BY.get(sort, SHOP_ORDER_BY['newest'])
+        products = conn.execute(query + ' LIMIT ? OFFSET ?', params + [SHOP_PER_PAGE, (page - 1) * SHOP_PER_PAGE]).fetchall()
+        shop_cache.set(cache_key, (products, category_stats, total))
+    
+    # Sample from a cached id list rather than sorting every in-stock row with ORDER BY RANDOM()
+    in_stock_ids = shop_cache.get('in_stock_ids')
+    if in_stock_ids is None:
+        in_stock_ids = [row[0] for row in conn.execute('SELECT id FROM products WHERE stock > 0')]
+        shop_cache.set('in_stock_ids', in_stock_ids)
+    picks = random.sample(in_stock_ids, min(6, len(in_stock_ids)))
+    recommendations = []
+    if picks:
+        placeholders = ','.join('?' * len(picks))
+        products_by_id = {product['id']: product for product in conn.execute(
+            f'SELECT {PRODUCT_CARD_COLUMNS} FROM products WHERE stock > 0 AND id IN ({placeholders})', picks)}
+        recommendations = [products_by_id[product_id] for product_id in picks if product_id in products_by_id]
     
     recent_searches = []
     if 'customer_id' in session and 'search_history' in session:
-        recent_searches = list(reversed(session['search_history'][-5:]))
+        recent_searches = list(reversed(session['search_history'][-MAX_SEARCH_HISTORY:]))
     
-    return render_template('customer/shop.html', products=products, wine_type=wine_type, search=search, sort=sort, cart_count=get_cart_count(), recent_searches=recent_searches, recommendations=recommendations, category_stats=category_stats)
+    return stream_page('customer/shop.html', products=products, wine_type=wine_type, search=search, sort=sort, recent_searches=recent_searches, recommendations=recommendations, category_stats=category_stats, total=total, page=page, per_page=SHOP_PER_PAGE)
 
 @app.route('/product/<int:product_id>')
 def product_detail(product_id):
-    conn = get_db_connection()
+    conn = get_db()
     product = conn.execute('SELECT * FROM products WHERE id = ?', (product_id,)).fetchone()
-    conn.close()
     
     if not product:
         flash('Product not found', 'error')
         return redirect(url_for('shop'))
     
-    if 'browsing_history' not in session:
-        session['browsing_history'] = []
+    history = session.get('browsing_history', [])
+    if not history or history[-1] != product_id:
+        history = [viewed_id for viewed_id in history if viewed_id != product_id]
+        session['browsing_history'] = history[-(MAX_BROWSING_HISTORY - 1):] + [product_id]
     
-    history = list(session['browsing_history'])
-    if product_id in history:
-        history.remove(product_id)
-    history.append(product_id)
-    if len(history) > 50:
-        history = history[-50:]
-    session['browsing_history'] = history
-    session.modified = True
-    
-    return render_template('customer/product_detail.html', product=product, cart_count=get_cart_count())
+    return render_template('customer/product_detail.html', product=product)
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -335,19 +417,16 @@ def register():
             flash('Please enter a complete delivery address (minimum 20 characters)', 'error')
             return redirect(url_for('register'))
         
-        hashed_pw = hashlib.sha256(password.encode()).hexdigest()
-        conn = get_db_connection()
-        existing = conn.execute('SELECT * FROM customers WHERE email = ?', (email,)).fetchone()
+        conn = get_db()
+        hashed_pw = generate_password_hash(password)
+        inserted = conn.execute('''INSERT INTO customers (name, email, password, phone, address) VALUES (?, ?, ?, ?, ?)
+                                   ON CONFLICT(email) DO NOTHING''', (name, email, hashed_pw, phone, address)).rowcount
+        conn.commit()
         
-        if existing:
+        if not inserted:
             flash('Email already registered', 'error')
-            conn.close()
             return redirect(url_for('register'))
         
-        conn.execute('INSERT INTO customers (name, email, password, phone, address) VALUES (?, ?, ?, ?, ?)', (name, email, hashed_pw, phone, address))
-        conn.commit()
-        conn.close()
-        
         flash('Registration successful! Please login.', 'success')
         return redirect(url_for('login'))
     
@@ -358,13 +437,16 @@ def login():
     if request.method == 'POST':
         email = request.form['email']
         password = request.form['password']
-        hashed_pw = hashlib.sha256(password.encode()).hexdigest()
         
-        conn = get_db_connection()
-        customer = conn.execute('SELECT * FROM customers WHERE email = ? AND password = ?', (email, hashed_pw)).fetchone()
-        conn.close()
+        conn = get_db()
+        customer = conn.execute('SELECT id, name, email, password FROM customers WHERE email = ?', (email,)).fetchone()
         
-        if customer:
+        if customer and verify_password(customer['password'], password):
+            if ':' not in customer['password']:
+                conn.execute('UPDATE customers SET password = ? WHERE id = ?',
+                             (generate_password_hash(password), customer['id']))
+                conn.commit()
+            
             session['customer_id'] = customer['id']
             session['customer_name'] = customer['name']
             session['customer_email'] = customer['email']
@@ -385,9 +467,8 @@ def logout():
 @app.route('/cart/add/<int:product_id>', methods=['POST'])
 def add_to_cart(product_id):
     quantity = int(request.form.get('quantity', 1))
-    conn = get_db_connection()
-    product = conn.execute('SELECT * FROM products WHERE id = ?', (product_id,)).fetchone()
-    conn.close()
+    conn = get_db()
+    product = conn.execute('SELECT name, stock FROM products WHERE id = ?', (product_id,)).fetchone()
     
     if not product:
         flash('Product not found', 'error')
@@ -398,10 +479,7 @@ def add_to_cart(product_id):
         return redirect(url_for('product_detail', product_id=product_id))
     
     cart = get_cart()
-    if str(product_id) in cart:
-        cart[str(product_id)]['quantity'] += quantity
-    else:
-        cart[str(product_id)] = {'id': product['id'], 'name': product['name'], 'price': product['price'], 'image_url': product['image_url'], 'quantity': quantity, 'stock': product['stock']}
+    cart[str(product_id)] = cart.get(str(product_id), 0) + quantity
     
     save_cart(cart)
     flash(f'Added {product["name"]} to cart', 'success')
@@ -409,9 +487,9 @@ def add_to_cart(product_id):
 
 @app.route('/cart')
 def view_cart():
-    cart = get_cart()
-    total = get_cart_total()
-    return render_template('customer/cart.html', cart=cart, total=total, cart_count=get_cart_count())
+    cart = load_cart_items(get_cart())
+    total = get_cart_total(cart)
+    return render_template('customer/cart.html', cart=cart, total=total)
 
 @app.route('/cart/update/<int:product_id>', methods=['POST'])
 def update_cart(product_id):
@@ -423,7 +501,7 @@ def update_cart(product_id):
             del cart[str(product_id)]
             flash('Item removed from cart', 'success')
         else:
-            cart[str(product_id)]['quantity'] = quantity
+            cart[str(product_id)] = quantity
             flash('Cart updated', 'success')
     
     save_cart(cart)
@@ -441,9 +519,8 @@ def remove_from_cart(product_id):
 @app.route('/buy-now/<int:product_id>', methods=['POST'])
 def buy_now(product_id):
     quantity = int(request.form.get('quantity', 1))
-    conn = get_db_connection()
-    product = conn.execute('SELECT * FROM products WHERE id = ?', (product_id,)).fetchone()
-    conn.close()
+    conn = get_db()
+    product = conn.execute('SELECT stock FROM products WHERE id = ?', (product_id,)).fetchone()
     
     if not product:
         flash('Product not found', 'error')
@@ -457,8 +534,7 @@ def buy_now(product_id):
         flash('Please login first to purchase', 'error')
         return redirect(url_for('login'))
     
-    buy_now_cart = {str(product_id): {'id': product['id'], 'name': product['name'], 'price': product['price'], 'image_url': product['image_url'], 'quantity': quantity, 'stock': product['stock']}}
-    session['buy_now_cart'] = buy_now_cart
+    session['buy_now_cart'] = {str(product_id): quantity}
     session['is_buy_now'] = True
     session.modified = True
     return redirect(url_for('buy_now_checkout'))
@@ -466,93 +542,79 @@ def buy_now(product_id):
 @app.route('/buy-now-checkout', methods=['GET', 'POST'])
 @login_required
 def buy_now_checkout():
-    buy_now_cart = session.get('buy_now_cart', {})
+    buy_now_cart = load_cart_items(get_cart('buy_now_cart'))
     
     if not buy_now_cart:
         flash('No product selected for quick purchase', 'error')
         return redirect(url_for('shop'))
     
-    conn = get_db_connection()
-    customer = conn.execute('SELECT * FROM customers WHERE id = ?', (session['customer_id'],)).fetchone()
+    conn = get_db()
+    customer = conn.execute('SELECT phone, address FROM customers WHERE id = ?', (session['customer_id'],)).fetchone()
     
     if not customer['phone'] or not customer['address']:
         flash('Please update your phone number and delivery address in your profile before checking out', 'error')
-        conn.close()
         return redirect(url_for('profile'))
     
     if len(customer['phone'].strip()) < 11 or len(customer['address'].strip()) < 11:
         flash('Please provide a valid phone number and complete delivery address in your profile', 'error')
-        conn.close()
         return redirect(url_for('profile'))
     
     if request.method == 'POST':
-        for item in buy_now_cart.values():
-            order_data = {'customer_id': session['customer_id'], 'product_id': item['id'], 'quantity': item['quantity'], 'total_price': item['price'] * item['quantity'], 'status': 'Pending'}
-            order_queue.enqueue(order_data)
-            conn.execute('INSERT INTO orders (customer_id, product_id, quantity, total_price, status) VALUES (?, ?, ?, ?, ?)', (order_data['customer_id'], order_data['product_id'], order_data['quantity'], order_data['total_price'], order_data['status']))
-            conn.execute('UPDATE products SET stock = stock - ? WHERE id = ?', (item['quantity'], item['id']))
+        if not place_orders(conn, session['customer_id'], buy_now_cart.values()):
+            flash('Insufficient stock', 'error')
+            return redirect(url_for('product_detail', product_id=next(iter(buy_now_cart.values()))['id']))
         
-        conn.commit()
-        conn.close()
         session['buy_now_cart'] = {}
         session['is_buy_now'] = False
         session.modified = True
         flash('Order placed successfully!', 'success')
         return redirect(url_for('my_orders'))
     
-    total = sum(item['price'] * item['quantity'] for item in buy_now_cart.values())
-    conn.close()
-    return render_template('customer/buy_now_checkout.html', cart=buy_now_cart, total=total, cart_count=get_cart_count())
+    total = get_cart_total(buy_now_cart)
+    return render_template('customer/buy_now_checkout.html', cart=buy_now_cart, total=total)
 
 @app.route('/checkout', methods=['GET', 'POST'])
 @login_required
 def checkout():
-    cart = get_cart()
+    cart = load_cart_items(get_cart())
     
     if not cart:
         flash('Your cart is empty', 'error')
         return redirect(url_for('shop'))
     
-    conn = get_db_connection()
-    customer = conn.execute('SELECT * FROM customers WHERE id = ?', (session['customer_id'],)).fetchone()
+    conn = get_db()
+    customer = conn.execute('SELECT phone, address FROM customers WHERE id = ?', (session['customer_id'],)).fetchone()
     
     if not customer['phone'] or not customer['address']:
         flash('Please update your phone number and delivery address in your profile before checking out', 'error')
-        conn.close()
         return redirect(url_for('profile'))
     
     if len(customer['phone'].strip()) < 10 or len(customer['address'].strip()) < 20:
         flash('Please provide a valid phone number and complete delivery address in your profile', 'error')
-        conn.close()
         return redirect(url_for('profile'))
     
     if request.method == 'POST':
-        for item in cart.values():
-            order_data = {'customer_id': session['customer_id'], 'product_id': item['id'], 'quantity': item['quantity'], 'total_price': item['price'] * item['quantity'], 'status': 'Pending'}
-            order_queue.enqueue(order_data)
-            conn.execute('INSERT INTO orders (customer_id, product_id, quantity, total_price, status) VALUES (?, ?, ?, ?, ?)', (order_data['customer_id'], order_data['product_id'], order_data['quantity'], order_data['total_price'], order_data['status']))
-            conn.execute('UPDATE products SET stock = stock - ? WHERE id = ?', (item['quantity'], item['id']))
+        if not place_orders(conn, session['customer_id'], cart.values()):
+            flash('Some items in your cart no longer have enough stock', 'error')
+            return redirect(url_for('view_cart'))
         
-        conn.commit()
-        conn.close()
-        session['cart'] = {}
-        session.modified = True
+        save_cart({})
         flash('Order placed successfully!', 'success')
         return redirect(url_for('my_orders'))
     
-    total = get_cart_total()
-    conn.close()
-    return render_template('customer/checkout.html', cart=cart, total=total, cart_count=get_cart_count())
+    total = get_cart_total(cart)
+    return render_template('customer/checkout.html', cart=cart, total=total)
 
 @app.route('/my-orders')
 @login_required
 def my_orders():
     status_filter = request.args.get('status', '')
-    conn = get_db_connection()
+    conn = get_db()
     
-    pending_count = conn.execute('SELECT COUNT(*) as count FROM orders WHERE customer_id = ? AND status = "Pending"', (session['customer_id'],)).fetchone()['count']
-    processing_count = conn.execute('SELECT COUNT(*) as count FROM orders WHERE customer_id = ? AND status = "Processing"', (session['customer_id'],)).fetchone()['count']
-    delivered_count = conn.execute('SELECT COUNT(*) as count FROM orders WHERE customer_id = ? AND status = "Delivered"', (session['customer_id'],)).fetchone()['count']
+    status_counts = dict(conn.execute('SELECT status, COUNT(*) FROM orders WHERE customer_id = ? GROUP BY status', (session['customer_id'],)).fetchall())
+    pending_count = status_counts.get('Pending', 0)
+    processing_count = status_counts.get('Processing', 0)
+    delivered_count = status_counts.get('Delivered', 0)
     
     query = 'SELECT o.*, p.name as product_name, p.type as product_type, p.image_url as product_image, o.estimated_delivery_date, o.shipped_date FROM orders o JOIN products p ON o.product_id = p.id WHERE o.customer_id = ?'
     params = [session['customer_id']]
@@ -562,31 +624,30 @@ def my_orders():
         params.append(status_filter)
     
     query += ' ORDER BY o.order_date DESC'
-    orders = conn.execute(query, params).fetchall()
-    conn.close()
+    orders = conn.execute(query, params)
+    total = status_counts.get(status_filter, 0) if status_filter else sum(status_counts.values())
     
-    return render_template('customer/my_orders.html', orders=orders, status_filter=status_filter, pending_count=pending_count, processing_count=processing_count, delivered_count=delivered_count, cart_count=get_cart_count())
+    return stream_page('customer/my_orders.html', orders=orders, total=total, status_filter=status_filter, pending_count=pending_count, processing_count=processing_count, delivered_count=delivered_count)
 
 @app.route('/order/cancel/<int:order_id>', methods=['POST'])
 @login_required
 def cancel_order(order_id):
-    conn = get_db_connection()
+    conn = get_db()
     order = conn.execute('SELECT o.*, p.name as product_name FROM orders o JOIN products p ON o.product_id = p.id WHERE o.id = ? AND o.customer_id = ?', (order_id, session['customer_id'])).fetchone()
     
     if not order:
         flash('Order not found', 'error')
-        conn.close()
         return redirect(url_for('my_orders'))
     
     if order['status'] != 'Pending':
         flash('Only pending orders can be cancelled', 'error')
-        conn.close()
         return redirect(url_for('my_orders'))
     
     conn.execute('UPDATE orders SET status = "Cancelled" WHERE id = ?', (order_id,))
     conn.execute('UPDATE products SET stock = stock + ? WHERE id = ?', (order['quantity'], order['product_id']))
     conn.commit()
-    conn.close()
+    shop_cache.clear()
+    notification_cache.discard(session['customer_id'])
     
     flash(f'Order #{order_id} for {order["product_name"]} has been cancelled', 'success')
     return redirect(url_for('my_orders'))
@@ -594,22 +655,20 @@ def cancel_order(order_id):
 @app.route('/order/received/<int:order_id>', methods=['POST'])
 @login_required
 def mark_received(order_id):
-    conn = get_db_connection()
+    conn = get_db()
     order = conn.execute('SELECT o.*, p.name as product_name FROM orders o JOIN products p ON o.product_id = p.id WHERE o.id = ? AND o.customer_id = ?', (order_id, session['customer_id'])).fetchone()
     
     if not order:
         flash('Order not found', 'error')
-        conn.close()
         return redirect(url_for('my_orders'))
     
     if order['status'] != 'Delivered':
         flash('Only delivered orders can be marked as received', 'error')
-        conn.close()
         return redirect(url_for('my_orders'))
     
     conn.execute('UPDATE orders SET status = "Received" WHERE id = ?', (order_id,))
     conn.commit()
-    conn.close()
+    notification_cache.discard(session['customer_id'])
     
     flash(f'Order #{order_id} marked as received. Thank you!', 'success')
     return redirect(url_for('my_orders'))
@@ -617,23 +676,18 @@ def mark_received(order_id):
 @app.route('/profile')
 @login_required
 def profile():
-    conn = get_db_connection()
-    customer = conn.execute('SELECT * FROM customers WHERE id = ?', (session['customer_id'],)).fetchone()
-    
-    if 'browsing_history' not in session:
-        session['browsing_history'] = []
+    conn = get_db()
+    customer = conn.execute('SELECT id, name, email, phone, address, joined_at FROM customers WHERE id = ?', (session['customer_id'],)).fetchone()
     
     history_products = []
-    if session['browsing_history']:
-        recent_views = list(session['browsing_history'])[-10:]
-        recent_views.reverse()
-        for product_id in recent_views:
-            product = conn.execute('SELECT * FROM products WHERE id = ?', (product_id,)).fetchone()
-            if product:
-                history_products.append(product)
+    if session.get('browsing_history'):
+        recent_views = list(reversed(session['browsing_history'][-MAX_BROWSING_HISTORY:]))
+        placeholders = ','.join('?' * len(recent_views))
+        products = {product['id']: product for product in conn.execute(
+            f'SELECT {PRODUCT_CARD_COLUMNS} FROM products WHERE id IN ({placeholders})', recent_views)}
+        history_products = [products[product_id] for product_id in recent_views if product_id in products]
     
-    conn.close()
-    return render_template('customer/profile.html', customer=customer, cart_count=get_cart_count(), browsing_history=history_products)
+    return render_template('customer/profile.html', customer=customer, browsing_history=history_products)
 
 @app.route('/history/clear', methods=['POST'])
 @login_required
@@ -674,12 +728,17 @@ def edit_profile():
         flash('Please enter a complete delivery address (minimum 10 characters)', 'error')
         return redirect(url_for('profile'))
     
-    conn = get_db_connection()
-    conn.execute('UPDATE customers SET name = ?, phone = ?, address = ? WHERE id = ?', (name, phone, address, session['customer_id']))
+    conn = get_db()
+    customer = conn.execute('UPDATE customers SET name = ?, phone = ?, address = ? WHERE id = ? RETURNING name',
+                            (name, phone, address, session['customer_id'])).fetchone()
     conn.commit()
-    conn.close()
     
-    session['customer_name'] = name
+    if not customer:
+        session.clear()
+        flash('Your account no longer exists. Please login again.', 'error')
+        return redirect(url_for('login'))
+    
+    session['customer_name'] = customer['name']
     flash('Profile updated successfully', 'success')
     return redirect(url_for('profile'))
 
@@ -698,20 +757,15 @@ def change_password():
         flash('Password must be at least 6 characters', 'error')
         return redirect(url_for('profile'))
     
-    current_hashed = hashlib.sha256(current_password.encode()).hexdigest()
-    new_hashed = hashlib.sha256(new_password.encode()).hexdigest()
+    conn = get_db()
+    customer = conn.execute('SELECT password FROM customers WHERE id = ?', (session['customer_id'],)).fetchone()
     
-    conn = get_db_connection()
-    customer = conn.execute('SELECT * FROM customers WHERE id = ? AND password = ?', (session['customer_id'], current_hashed)).fetchone()
-    
-    if not customer:
+    if not customer or not verify_password(customer['password'], current_password):
         flash('Current password is incorrect', 'error')
-        conn.close()
         return redirect(url_for('profile'))
     
-    conn.execute('UPDATE customers SET password = ? WHERE id = ?', (new_hashed, session['customer_id']))
+    conn.execute('UPDATE customers SET password = ? WHERE id = ?', (generate_password_hash(new_password), session['customer_id']))
     conn.commit()
-    conn.close()
     
     flash('Password changed successfully!', 'success')
     return redirect(url_for('profile'))
@@ -726,26 +780,22 @@ def delete_account():
         flash('Please type DELETE to confirm account deletion', 'error')
         return redirect(url_for('profile'))
     
-    hashed_pw = hashlib.sha256(password.encode()).hexdigest()
-    conn = get_db_connection()
-    customer = conn.execute('SELECT * FROM customers WHERE id = ? AND password = ?', (session['customer_id'], hashed_pw)).fetchone()
+    conn = get_db()
+    customer = conn.execute('SELECT password FROM customers WHERE id = ?', (session['customer_id'],)).fetchone()
     
-    if not customer:
+    if not customer or not verify_password(customer['password'], password):
         flash('Incorrect password', 'error')
-        conn.close()
         return redirect(url_for('profile'))
     
     pending_orders = conn.execute('SELECT COUNT(*) as count FROM orders WHERE customer_id = ? AND status IN ("Pending", "Processing")', (session['customer_id'],)).fetchone()['count']
     
     if pending_orders > 0:
         flash('Cannot delete account with pending or processing orders', 'error')
-        conn.close()
         return redirect(url_for('profile'))
     
     conn.execute('DELETE FROM orders WHERE customer_id = ?', (session['customer_id'],))
     conn.execute('DELETE FROM customers WHERE id = ?', (session['customer_id'],))
     conn.commit()
-    conn.close()
     
     session.clear()
     flash('Your account has been permanently deleted', 'success')
@@ -754,12 +804,12 @@ def delete_account():
 @app.route('/messages')
 @login_required
 def messages():
-    conn = get_db_connection()
+    conn = get_db()
     messages = conn.execute('SELECT * FROM messages WHERE customer_id = ? ORDER BY created_at ASC', (session['customer_id'],)).fetchall()
     conn.execute('UPDATE messages SET is_read = 1 WHERE customer_id = ? AND sender_type = "admin" AND is_read = 0', (session['customer_id'],))
     conn.commit()
-    conn.close()
-    return render_template('customer/messages.html', messages=messages, cart_count=get_cart_count())
+    notification_cache.discard(session['customer_id'])
+    return render_template('customer/messages.html', messages=messages)
 
 @app.route('/messages/send', methods=['POST'])
 @login_required
@@ -774,10 +824,9 @@ def send_message():
         flash('Message is too long (max 1000 characters)', 'error')
         return redirect(url_for('messages'))
     
-    conn = get_db_connection()
+    conn = get_db()
     conn.execute('INSERT INTO messages (customer_id, sender_type, message) VALUES (?, "customer", ?)', (session['customer_id'], message_text))
     conn.commit()
-    conn.close()
     
     flash('Message sent to admin successfully!', 'success')
     return redirect(url_for('messages'))
@@ -785,9 +834,8 @@ def send_message():
 def get_unread_message_count():
     if 'customer_id' not in session:
         return 0
-    conn = get_db_connection()
+    conn = get_db()
     count = conn.execute('SELECT COUNT(*) as count FROM messages WHERE customer_id = ? AND sender_type = "admin" AND is_read = 0''', (session['customer_id'],)).fetchone()['count']
-    conn.close()
     
     return count
 
@@ -7,54 +7,52 @@ def test_delivery_dates():
     print("Testing Delivery Date Feature")
     print("=" * 60)
     
-    conn = sqlite3.connect('cellar_society.db')
+    # The script opens its own transaction below, so the module's implicit BEGIN handling is off
+    conn = sqlite3.connect('cellar_society.db', isolation_level=None)
+    # Same journal settings as the apps, so the script can run while they are serving
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA mmap_size=268435456')
     c = conn.cursor()
     
-    # Get all orders
-    c.execute("SELECT id, status FROM orders")
-    orders = c.fetchall()
-    
-    if not orders:
-        print("❌ No orders found. Please create an order first.")
-        conn.close()
-        return
-    
-    print(f"\nFound {len(orders)} order(s)")
-    print("\nUpdating orders with status 'Processing' or 'Delivered'...\n")
-    
     shipped_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     delivery_date = (datetime.now() + timedelta(days=4)).strftime('%Y-%m-%d')
     
-    updated_count = 0
+    print("\nUpdating orders with status 'Processing' or 'Delivered'...\n")
     
-    for order_id, status in orders:
-        if status in ['Processing', 'Delivered']:
-            c.execute('''
-                UPDATE orders 
-                SET shipped_date = ?, estimated_delivery_date = ?
-                WHERE id = ?
-            ''', (shipped_date, delivery_date, order_id))
-            print(f"✅ Updated Order #{order_id} (Status: {status})")
-            print(f"   Shipped: {shipped_date}")
-            print(f"   Delivery: {delivery_date}")
-            updated_count += 1
+    # Both updates land in one transaction; a failure or early return leaves the orders untouched
+    c.execute('BEGIN IMMEDIATE')
+    c.execute('''
+        UPDATE orders 
+        SET shipped_date = ?, estimated_delivery_date = ?
+        WHERE status IN ('Processing', 'Delivered')
+    ''', (shipped_date, delivery_date))
+    updated_count = c.rowcount
     
     if updated_count == 0:
         print("No orders with 'Processing' or 'Delivered' status found.")
         print("Updating first order as test...")
-        if orders:
-            order_id = orders[0][0]
-            c.execute('''
-                UPDATE orders 
-                SET status = 'Processing',
-                    shipped_date = ?, 
-                    estimated_delivery_date = ?
-                WHERE id = ?
-            ''', (shipped_date, delivery_date, order_id))
-            print(f"✅ Updated Order #{order_id} to Processing with delivery date")
-            updated_count = 1
+        order = c.execute('''
+            UPDATE orders 
+            SET status = 'Processing',
+                shipped_date = ?, 
+                estimated_delivery_date = ?
+            WHERE id = (SELECT MIN(id) FROM orders)
+            RETURNING id
+        ''', (shipped_date, delivery_date)).fetchone()
+        
+        if not order:
+            print("❌ No orders found. Please create an order first.")
+            conn.close()
+            return
+        
+        print(f"✅ Updated Order #{order[0]} to Processing with delivery date")
+        updated_count = 1
+    else:
+        print(f"✅ Shipped: {shipped_date}, Delivery: {delivery_date}")
     
     conn.commit()
+    conn.execute('PRAGMA optimize')
     conn.close()
     
     print(f"\n✅ Updated {updated_count} order(s)")